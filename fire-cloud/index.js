@@ -12,7 +12,8 @@ const SUPABASE_API_KEY = process.env.SUPABASE_API_KEY;
 const ENDPOINT = process.env.MQTT_HOST;
 const REGION = "ap-southeast-1";
 const CLIENT_ID = `FIRE-CLOUD`;
-const SENSOR_DATA_TOPIC = "greendot/sensor/data";
+// gateways may shard sensor data per node (greendot/sensor/data/{id}); "#" also matches the unsharded topic
+const SENSOR_DATA_TOPIC = "greendot/sensor/data/#";
 const FLAME_PRESENCE_TOPIC = "greendot/status";
 
 /* e.g. node id 1 has status 0 */
@@ -27,6 +28,60 @@ const noFireDurations = {
     1: null,
 };
 
+/* last reported reading per node id, used to fill in readings suppressed by the node's deadband */
+const lastReadings = {};
+const MAX_CARRIED_ROWS = 300;
+
+// Nodes only report on change. The readings they skipped are copies of the last report,
+// spaced by its sampling interval and never further out than its max silence window.
+// A gap is only filled when nothing was sent in between: same boot, the next sequence
+// number, and not the first reading on a new connection.
+function getCarriedRows(messageJson) {
+    const lastReading = lastReadings[messageJson.id];
+    if (!lastReading || !lastReading.interval || messageJson.first) return [];
+    if (messageJson.boot !== lastReading.boot || messageJson.seq !== lastReading.seq + 1) return [];
+
+    const interval = lastReading.interval;
+    const silenceEnd = lastReading.timestamp + (lastReading.max_silence ?? 0);
+    const rows = [];
+    let timestamp = lastReading.timestamp + interval;
+    while (
+        timestamp <= messageJson.timestamp - interval / 2 &&
+        timestamp <= silenceEnd &&
+        rows.length < MAX_CARRIED_ROWS
+    ) {
+        rows.push({
+            node_id: lastReading.id,
+            timestamp: convertEpochToUTC(timestamp),
+            temperature: lastReading.temp,
+            humidity: lastReading.humidity,
+            air_quality_ppm: lastReading.air,
+            flame_sensor_value: lastReading.flame,
+            carried: true,
+        });
+        timestamp += interval;
+    }
+    return rows;
+}
+
+/* recently seen "boot:seq" keys per node id, used to drop readings forwarded by two gateways during handover */
+const recentSequences = {};
+const RECENT_SEQUENCES_LIMIT = 256;
+
+function isDuplicateReading(messageJson) {
+    if (messageJson.seq === undefined) return false;
+
+    const nodeId = messageJson.id;
+    const key = `${messageJson.boot}:${messageJson.seq}`;
+    if (!recentSequences[nodeId]) recentSequences[nodeId] = new Set();
+    const seen = recentSequences[nodeId];
+    if (seen.has(key)) return true;
+
+    seen.add(key);
+    if (seen.size > RECENT_SEQUENCES_LIMIT) seen.delete(seen.values().next().value);
+    return false;
+}
+
 if (!SUPABASE_URL || !SUPABASE_API_KEY) {
     console.error("Missing SUPABASE_URL or SUPABASE_API_KEY environment variable");
     process.exit(1);
@@ -86,7 +141,31 @@ async function connectAndSubscribe() {
         const messageJson = JSON.parse(messageString);
         console.log(`Message received on ${topic}:`, messageJson);
 
+        if (isDuplicateReading(messageJson)) {
+            console.log(`Dropping duplicate reading from node ${messageJson.id}`);
+            return;
+        }
+
         const nodeId = messageJson.id;
+
+        // a sensor error ends the suppressed gap; nothing after the last report is carried forward
+        if (messageJson.error) {
+            console.log(`Node ${nodeId} reported a ${messageJson.error} error`);
+            delete lastReadings[nodeId];
+            return;
+        }
+
+        const carriedRows = getCarriedRows(messageJson);
+        // a late message (mixed QoS, several gateway connections) must not move the baseline back
+        if (!lastReadings[nodeId] || messageJson.timestamp > lastReadings[nodeId].timestamp) {
+            lastReadings[nodeId] = messageJson;
+        }
+        if (carriedRows.length > 0) {
+            // carried rows keep the series regular but are not analysed on their own
+            const { error: carriedError } = await supabase.from("firecloud").insert(carriedRows);
+            if (carriedError) console.error(carriedError);
+        }
+
         const temperature = messageJson.temp;
         const humidity = messageJson.humidity;
         const airQualityPpm = messageJson.air;
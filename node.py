@@ -3,6 +3,8 @@ import bluetooth
 import uasyncio as asyncio
 import aioble
 import json
+import random
+import time
 from sensors import SensorsManager
 
 # BLE
@@ -16,11 +18,22 @@ MTU=512
 _DEVICE_NAME_PREFIX = "GREENDOT-"
 _NODE_ID = 0
 _DEVICE_NAME = _DEVICE_NAME_PREFIX + str(_NODE_ID)
+_BOOT_ID = random.getrandbits(16) # with 'seq', lets the cloud drop readings delivered twice
 
 # Sampling intervals
 _SAMPLING_INTERVAL_LOW =  5 # Actual: 60s, Demo: 30s
 _SAMPLING_INTERVAL_HIGH = 1
 
+# Report-by-exception: a reading is only sent when a field moves past its deadband,
+# the flame value changes, or the node has been silent for _MAX_SILENCE_MS
+_REPORT_ON_CHANGE = True
+_DEADBANDS = {
+    'temp': 0.2, # deg C
+    'humidity': 1.0, # %RH
+    'air': 5, # ppm
+}
+_MAX_SILENCE_MS = 300_000 # heartbeat every 5 minutes at most
+
 # Frequencies
 _FREQ_HIGH = 160000000 # 160 MHz
 _FREQ_LOW = 80000000 # 80 MHz (any lower and esp32 will not run as intended)
@@ -37,6 +50,10 @@ class BlePeripheralManager:
         self.start_sending_event = asyncio.Event()
         self.connection_to_send_to = None
         self.sampling_interval = _SAMPLING_INTERVAL_LOW
+        self.last_sent_reading = None
+        self.last_sent_ticks = None
+        self.sequence_number = 0
+        self.new_connection = False
         self.greendot_service = aioble.Service(_GREENDOT_SERVICE_UUID)
         self.data_characteristic = aioble.Characteristic(self.greendot_service, _DATA_UUID, read=True, write=True, notify=True)
         self.flame_presence_characteristic = aioble.Characteristic(self.greendot_service, _FLAME_PRESENCE_UUID, read=True, write=True, notify=True, capture=True)
@@ -61,6 +78,8 @@ class BlePeripheralManager:
             )
             print("Connection from", connection.device)
             self.connection_to_send_to = connection
+            self.last_sent_reading = None # always send the first reading to a new gateway
+            self.new_connection = True # the cloud must not fill the gap before this reading
             self.start_sending_event.set()
             while connection.is_connected() == True:
                     await asyncio.sleep(5)
@@ -82,18 +101,21 @@ class BlePeripheralManager:
                        temp_humidity_reading = self.sensors_manager.get_temp_humidity()
                     except Exception as e:
                         print("Error reading sensor values:", e)
+                        await self.__notify_sensor_error()
                         await asyncio.sleep(5)
                         continue
                     try:
                        air_reading = self.sensors_manager.get_air_quality(temp_humidity_reading[0],temp_humidity_reading[1])
                     except Exception as e:
                         print("Error reading sensor values:", e)
+                        await self.__notify_sensor_error()
                         await asyncio.sleep(5)
                         continue
                     try:
                        flame_reading = self.sensors_manager.get_flame_presence()
                     except Exception as e:
                         print("Error reading sensor values:", e)
+                        await self.__notify_sensor_error()
                         await asyncio.sleep(5)
                         continue
                     
@@ -101,29 +123,76 @@ class BlePeripheralManager:
                     # air_reading = self.sensors_manager.get_air_quality(temp_humidity_reading[0], temp_humidity_reading[1])
                     # flame_reading = self.sensors_manager.get_flame_presence()
                     
-                    await self.__notify(
-                        self.__encode_json_data({
-                            'id': _NODE_ID,
-                            'air': air_reading,
-                            'temp': temp_humidity_reading[0],
-                            'humidity': temp_humidity_reading[1],
-                            'flame': flame_reading,
-                        })
-                    )
+                    reading = {
+                        'id': _NODE_ID,
+                        'air': air_reading,
+                        'temp': temp_humidity_reading[0],
+                        'humidity': temp_humidity_reading[1],
+                        'flame': flame_reading,
+                        'interval': self.sampling_interval,
+                        'max_silence': _MAX_SILENCE_MS // 1000,
+                        'boot': _BOOT_ID,
+                        'seq': self.sequence_number,
+                        'first': self.new_connection,
+                    }
+                    if not self.__should_report(reading):
+                        print("Reading within deadband, skipping notification")
+                        await asyncio.sleep(self.sampling_interval)
+                        continue
+                    
+                    await self.__notify(self.__encode_json_data(reading))
+                    self.last_sent_reading = reading
+                    self.last_sent_ticks = time.ticks_ms()
+                    self.sequence_number += 1
+                    self.new_connection = False
             except Exception as e:
                 print("Error sending sensor data:", e)
                 await asyncio.sleep(5)
             
 
+    def __should_report(self, reading):
+        if not _REPORT_ON_CHANGE or self.sampling_interval == _SAMPLING_INTERVAL_HIGH:
+            return True
+        last = self.last_sent_reading
+        if last is None:
+            return True
+        if reading['flame'] != last['flame'] or reading['interval'] != last['interval']:
+            return True
+        if time.ticks_diff(time.ticks_ms(), self.last_sent_ticks) >= _MAX_SILENCE_MS:
+            return True
+        for field, deadband in _DEADBANDS.items():
+            if reading[field] is None or last[field] is None:
+                if reading[field] is not last[field]:
+                    return True
+            elif abs(reading[field] - last[field]) >= deadband:
+                return True
+        return False
+
+    async def __notify_sensor_error(self):
+        # Tell the gateway the gap that follows is a sensor failure, not an unchanged reading.
+        # Only sent once per failure; the next good reading is always reported.
+        if self.last_sent_reading is None:
+            return
+        self.last_sent_reading = None
+        self.__write_and_notify(self.__encode_json_data({
+            'id': _NODE_ID,
+            'error': 'sensor',
+            'boot': _BOOT_ID,
+            'seq': self.sequence_number,
+        }))
+        self.sequence_number += 1
+
     async def __notify(self, data):
         print("Sending sensor data...")
-        print(f"Sending {data} to {self.connection_to_send_to}")
-        
-        self.data_characteristic.write(data)
-        self.data_characteristic.notify(self.connection_to_send_to)
+        self.__write_and_notify(data)
         print("Sent sensor data")
         
         await asyncio.sleep(self.sampling_interval)
+
+    def __write_and_notify(self, data):
+        print(f"Sending {data} to {self.connection_to_send_to}")
+        self.data_characteristic.write(data)
+        self.data_characteristic.notify(self.connection_to_send_to)
     
     async def __listen_to_flame_presence(self):
         while True:
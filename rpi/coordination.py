@@ -0,0 +1,191 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import sys
+import time
+
+# Multi-gateway coordination
+HEARTBEAT_INTERVAL = 5  # seconds between gateway heartbeats
+GATEWAY_TIMEOUT = 15  # a gateway is gone after this many seconds without a heartbeat
+VIRTUAL_NODES = 64  # points per gateway on the hash ring
+
+
+class HashRing:
+    def __init__(self, gateway_ids=(), virtual_nodes=VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self.ring = []
+        for gateway_id in gateway_ids:
+            for i in range(virtual_nodes):
+                self.ring.append((self._hash("{}#{}".format(gateway_id, i)), gateway_id))
+        self.ring.sort()
+        self.hashes = [h for h, _ in self.ring]
+
+    def _hash(self, key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def owner(self, key):
+        if not self.ring:
+            return None
+        index = bisect.bisect(self.hashes, self._hash(key.lower())) % len(self.ring)
+        return self.ring[index][1]
+
+
+class GatewayCoordinator:
+    def __init__(self, gateway_id, publish, get_heard_nodes=lambda: ()):
+        self.gateway_id = gateway_id
+        self.publish = publish
+        self.get_heard_nodes = get_heard_nodes
+        self.started_at = time.monotonic()
+        self.last_seen = {}
+        self.heard_by = {}
+        self.members = (gateway_id,)
+        self.rings = {}
+
+    def heard_nodes(self):
+        return {addr.lower() for addr in self.get_heard_nodes()}
+
+    def handle_heartbeat(self, payload):
+        try:
+            message = json.loads(payload)
+            gateway_id = message['gateway']
+            nodes = {addr.lower() for addr in message.get('nodes', [])}
+        except Exception as e:
+            print(f"Invalid gateway heartbeat: {e}")
+            return
+        if gateway_id != self.gateway_id:
+            self.last_seen[gateway_id] = time.monotonic()
+            self.heard_by[gateway_id] = nodes
+            self.update_members()
+
+    def update_members(self):
+        now = time.monotonic()
+        for gateway_id, seen in list(self.last_seen.items()):
+            if now - seen > GATEWAY_TIMEOUT:
+                print(f"[GATEWAY LOST] {gateway_id}")
+                del self.last_seen[gateway_id]
+                self.heard_by.pop(gateway_id, None)
+        members = tuple(sorted([self.gateway_id] + list(self.last_seen)))
+        if members != self.members:
+            print(f"[GATEWAYS] {self.gateway_id} sees {list(members)}")
+            self.members = members
+            self.rings = {}
+
+    def is_ready(self):
+        # Wait one timeout after startup so the other gateways are known before claiming nodes
+        return time.monotonic() - self.started_at >= GATEWAY_TIMEOUT
+
+    def owns(self, addr):
+        # Hash only over the gateways that can hear the node, so a node heard by a
+        # single gateway always belongs to it
+        addr = addr.lower()
+        if not self.is_ready() or addr not in self.heard_nodes():
+            return False
+        candidates = tuple(g for g in self.members if g == self.gateway_id or addr in self.heard_by.get(g, ()))
+        if candidates not in self.rings:
+            self.rings[candidates] = HashRing(candidates)
+        return self.rings[candidates].owner(addr) == self.gateway_id
+
+    async def run(self):
+        while True:
+            try:
+                self.publish({
+                    'gateway': self.gateway_id,
+                    'timestamp': time.time(),
+                    'nodes': sorted(self.heard_nodes()),
+                })
+                self.update_members()
+            except Exception as e:
+                print(f"Failed to send gateway heartbeat: {e}")
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+
+# Simulate several gateways on one machine with an in-memory bus in place of MQTT:
+#   python coordination.py
+# Gateways sit along a line and each hears only the nodes near it. A node connected to
+# a gateway stops advertising, so only that gateway still hears it.
+class SimulatedGateway:
+    def __init__(self, gateway_id, in_range, connected_to, broadcast):
+        self.gateway_id = gateway_id
+        self.in_range = in_range
+        self.connected_to = connected_to
+        self.coordinator = GatewayCoordinator(gateway_id, broadcast, self.heard_nodes)
+
+    def heard_nodes(self):
+        return [addr for addr in self.in_range if self.connected_to.get(addr) in (None, self.gateway_id)]
+
+    def rebalance(self):
+        for addr in self.in_range:
+            holder = self.connected_to.get(addr)
+            owns = self.coordinator.owns(addr)
+            if holder is None and owns:
+                self.connected_to[addr] = self.gateway_id
+            elif holder == self.gateway_id and not owns:
+                del self.connected_to[addr]
+
+    def stop(self):
+        for addr, holder in list(self.connected_to.items()):
+            if holder == self.gateway_id:
+                del self.connected_to[addr]
+
+    async def run(self):
+        async def rebalance_loop():
+            while True:
+                self.rebalance()
+                await asyncio.sleep(HEARTBEAT_INTERVAL)
+        await asyncio.gather(self.coordinator.run(), rebalance_loop())
+
+
+def check_ownership(gateways, nodes, connected_to):
+    errors = []
+    for addr in nodes:
+        in_range = [g.gateway_id for g in gateways if addr in g.in_range]
+        owners = [g.gateway_id for g in gateways if g.coordinator.owns(addr)]
+        holder = connected_to.get(addr)
+        if len(owners) > 1:
+            errors.append(f"{addr} owned by {owners}")
+        elif in_range and holder is None:
+            errors.append(f"{addr} heard by {in_range} but not connected")
+        elif holder is not None and owners != [holder]:
+            errors.append(f"{addr} connected to {holder} but owned by {owners}")
+    for gateway in gateways:
+        held = [addr for addr in nodes if connected_to.get(addr) == gateway.gateway_id]
+        print(f"{gateway.gateway_id} in range of {len(gateway.in_range)}, connected to {len(held)}: {held}")
+    for error in errors:
+        print(f"[ERROR] {error}")
+    return not errors
+
+
+async def simulate(gateway_count=3, node_count=12, hearing_range=6):
+    gateways = []
+    connected_to = {}
+
+    def broadcast(message):
+        for gateway in gateways:
+            gateway.coordinator.handle_heartbeat(json.dumps(message))
+
+    nodes = ["24:0a:c4:00:00:{:02x}".format(i) for i in range(node_count)]
+    spacing = (node_count - hearing_range) / max(gateway_count - 1, 1)
+    for i in range(gateway_count):
+        first = round(i * spacing)
+        gateways.append(SimulatedGateway("SIM-{}".format(i), nodes[first:first + hearing_range], connected_to, broadcast))
+    tasks = {g.gateway_id: asyncio.create_task(g.run()) for g in gateways}
+
+    await asyncio.sleep(GATEWAY_TIMEOUT + 2 * HEARTBEAT_INTERVAL)
+    ok = check_ownership(gateways, nodes, connected_to)
+
+    stopped = gateways.pop()
+    print(f"Stopping {stopped.gateway_id}...")
+    tasks[stopped.gateway_id].cancel()
+    stopped.stop()
+    await asyncio.sleep(GATEWAY_TIMEOUT + 2 * HEARTBEAT_INTERVAL)
+    ok = check_ownership(gateways, nodes, connected_to) and ok
+
+    for task in tasks.values():
+        task.cancel()
+    return ok
+
+
+if __name__ == "__main__":
+    if not asyncio.run(simulate()):
+        sys.exit(1)
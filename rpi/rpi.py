@@ -1,11 +1,14 @@
 import asyncio
 from bluepy.btle import Scanner, DefaultDelegate, Peripheral, UUID, BTLEDisconnectError, BTLEException
 import json
+import os
 import time
 
 from awscrt import io, mqtt
 from awsiot import mqtt_connection_builder
 
+from coordination import GatewayCoordinator
+
 # MQTT and BLE Configuration
 MTU = 512
 
@@ -21,57 +24,145 @@ CERTFILE_PATH = "./certs/device.pem.crt"  # Client certificate
 KEYFILE_PATH = "./certs/private.pem.key"  # Private key
 
 MQTT_BROKER_ENDPOINT = "a3dhth9kymg9gk-ats.iot.ap-southeast-1.amazonaws.com"
-CLIENT_ID = "GREENDOT-RPI"  # Name for the Thing in AWS IoT
+GATEWAY_ID = os.environ.get("GREENDOT_GATEWAY_ID", "RPI")  # set per gateway when running several
+CLIENT_ID = "GREENDOT-" + GATEWAY_ID  # Name for the Thing in AWS IoT
 SENSOR_DATA_TOPIC = 'greendot/sensor/data'
 FLAME_PRESENCE_TOPIC = "greendot/status"
+GATEWAY_HEARTBEAT_TOPIC = "greendot/gateway/heartbeat"
+
+# Multi-gateway mode: gateways split nodes between them by consistent hashing on the node address
+MULTI_GATEWAY_MODE = os.environ.get("GREENDOT_MULTI_GATEWAY", "0") == "1"
+RESCAN_INTERVAL = 30  # seconds between scans for unclaimed nodes
+SIGHTING_TIMEOUT = 90  # a scanned node counts as heard for this long
+
+# MQTT uplink configuration
+MQTT_EVENT_LOOP_THREADS = 0  # 0 = one thread per CPU core
+MQTT_CONNECTION_COUNT = 1  # extra connections use CLIENT_ID-1, CLIENT_ID-2, ...
+SHARD_SENSOR_DATA_TOPIC = True  # publish to greendot/sensor/data/{id}
+SENSOR_DATA_QOS = mqtt.QoS.AT_MOST_ONCE  # routine telemetry
+FLAME_DATA_QOS = mqtt.QoS.AT_LEAST_ONCE  # readings with flame present or a flame change
+GAP_DATA_QOS = mqtt.QoS.AT_LEAST_ONCE  # first reading after a suppressed gap, and sensor errors
+STATUS_QOS = mqtt.QoS.AT_LEAST_ONCE
 
 
 class AsyncMQTTManager:
-    def __init__(self, broker_endpoint, client_id, loop):
+    def __init__(self, broker_endpoint, client_id, loop, connection_count=MQTT_CONNECTION_COUNT):
         self.loop = loop
-        self.client = self._establish_connection(broker_endpoint, client_id)
-        self.subscribe()
-        
-    def _establish_connection(self, broker_endpoint, client_id):
-        event_loop_group = io.EventLoopGroup(1)
+        self.broker_endpoint = broker_endpoint
+        self.client_bootstrap = self._create_client_bootstrap()
+        self.client_ids = [client_id] + ["{}-{}".format(client_id, i) for i in range(1, connection_count)]
+        self.clients = [self._build_connection(broker_endpoint, i) for i in range(len(self.client_ids))]
+        self.client = self.clients[0]
+        self.connected_clients = set()
+        self.connection_tasks = []
+        self.last_flame = {}
+        self.last_timestamps = {}
+        self.coordinator = None
+
+    def _create_client_bootstrap(self):
+        event_loop_group = io.EventLoopGroup(MQTT_EVENT_LOOP_THREADS)
         host_resolver = io.DefaultHostResolver(event_loop_group)
-        client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
-        mqtt_connection = mqtt_connection_builder.mtls_from_path(
+        return io.ClientBootstrap(event_loop_group, host_resolver)
+
+    def _build_connection(self, broker_endpoint, index):
+        return mqtt_connection_builder.mtls_from_path(
                 endpoint=broker_endpoint,
                 cert_filepath=CERTFILE_PATH,
                 pri_key_filepath=KEYFILE_PATH,
-                client_bootstrap=client_bootstrap,
+                client_bootstrap=self.client_bootstrap,
                 ca_filepath=CA_CERTS_PATH,
-                client_id=client_id,
+                client_id=self.client_ids[index],
                 clean_session=False,
-                keep_alive_secs=6
+                keep_alive_secs=6,
+                on_connection_interrupted=lambda connection, error, **kwargs: self._on_connection_interrupted(index, error),
+                on_connection_resumed=lambda connection, return_code, session_present, **kwargs: self._on_connection_resumed(index),
                 )
-        
-        print("Connecting to {} with client ID '{}'...".format(broker_endpoint, client_id))
+
+    # Called from the awscrt event loop threads; the connected set is only changed on the asyncio loop
+    def _on_connection_interrupted(self, index, error):
+        print("Connection '{}' interrupted: {}".format(self.client_ids[index], error))
+        self.loop.call_soon_threadsafe(self.connected_clients.discard, index)
+
+    def _on_connection_resumed(self, index):
+        print("Connection '{}' resumed".format(self.client_ids[index]))
+        self.loop.call_soon_threadsafe(self.connected_clients.add, index)
+
+    async def connect(self):
+        # Only the first connection is needed to start; extra ones are retried in the background
+        # and publishes fall back to the first connection until they are up
+        await self._establish_connection(0)
+        await self.subscribe()
+        self.connection_tasks = [self.loop.create_task(self._establish_connection(i)) for i in range(1, len(self.clients))]
+
+    async def _establish_connection(self, index):
+        mqtt_connection = self.clients[index]
+        client_id = self.client_ids[index]
+        print("Connecting to {} with client ID '{}'...".format(self.broker_endpoint, client_id))
         while True:
             try:
-                connect_future = mqtt_connection.connect()
-                connect_future.result()
-                print("Connected to MQTT broker!")
+                await asyncio.wrap_future(mqtt_connection.connect())
+                print("Connected to MQTT broker with client ID '{}'!".format(client_id))
+                self.connected_clients.add(index)
                 return mqtt_connection
             except Exception as e:
                 print(f"Error connecting or subscribing MQTT: {e}")
                 print("Retrying connection... in 2 seconds")
-                time.sleep(2)
-                
-        
-    def publish(self, topic, message):
-        self.client.publish(topic, json.dumps(message), mqtt.QoS.AT_LEAST_ONCE)
-        print("Published: '" + json.dumps(message) + "' to the topic: " + SENSOR_DATA_TOPIC + " for client: " + CLIENT_ID)
-        
-    def subscribe(self):
+                await asyncio.sleep(2)
+
+    def publish(self, topic, message, qos=SENSOR_DATA_QOS, shard_key=0):
+        # Messages with the same shard key share a connection so their order is kept
+        index = shard_key % len(self.clients)
+        if index not in self.connected_clients:
+            index = 0
+        self.clients[index].publish(topic, json.dumps(message), qos)
+        print("Published: '" + json.dumps(message) + "' to the topic: " + topic + " for client: " + self.client_ids[index])
+
+    def publish_sensor_data(self, data):
+        node_id = data.get('id', 0)
+        topic = "{}/{}".format(SENSOR_DATA_TOPIC, node_id) if SHARD_SENSOR_DATA_TOPIC else SENSOR_DATA_TOPIC
+        if 'error' in data:
+            # Error notices carry no sensor fields, so they must not reset flame-change detection
+            self.publish(topic, data, GAP_DATA_QOS, shard_key=node_id)
+            return
+        flame = data.get('flame')
+        flame_changed = node_id in self.last_flame and self.last_flame[node_id] != flame
+        self.last_flame[node_id] = flame
+        # A report that ends a deadband gap stands in for every sample the node skipped,
+        # so losing it at QoS 0 would lose the whole silence window
+        timestamp = data.get('timestamp', time.time())
+        last_timestamp = self.last_timestamps.get(node_id)
+        self.last_timestamps[node_id] = timestamp
+        after_gap = last_timestamp is None or timestamp - last_timestamp > 1.5 * data.get('interval', 0)
+        if flame == 1 or flame_changed:
+            qos = FLAME_DATA_QOS
+        elif after_gap:
+            qos = GAP_DATA_QOS
+        else:
+            qos = SENSOR_DATA_QOS
+        self.publish(topic, data, qos, shard_key=node_id)
+
+    async def subscribe(self):
         print("Subscribing to topic '{}'...".format(FLAME_PRESENCE_TOPIC))
-        self.client.subscribe(FLAME_PRESENCE_TOPIC, mqtt.QoS.AT_LEAST_ONCE, self._subscribe_callback)
+        subscribe_future, _ = self.client.subscribe(FLAME_PRESENCE_TOPIC, STATUS_QOS, self._subscribe_callback)
+        await asyncio.wrap_future(subscribe_future)
         print("[SUCCESS] subscribed to topic '{}'".format(FLAME_PRESENCE_TOPIC))
+        if self.coordinator:
+            print("Subscribing to topic '{}'...".format(GATEWAY_HEARTBEAT_TOPIC))
+            subscribe_future, _ = self.client.subscribe(GATEWAY_HEARTBEAT_TOPIC, mqtt.QoS.AT_MOST_ONCE, self._heartbeat_callback)
+            await asyncio.wrap_future(subscribe_future)
+            print("[SUCCESS] subscribed to topic '{}'".format(GATEWAY_HEARTBEAT_TOPIC))
 
-        
     def attach_ble_manager(self, ble_manager):
         self.ble_manager = ble_manager
+
+    def attach_coordinator(self, coordinator):
+        self.coordinator = coordinator
+
+    def publish_heartbeat(self, message):
+        self.publish(GATEWAY_HEARTBEAT_TOPIC, message, mqtt.QoS.AT_MOST_ONCE)
+
+    def _heartbeat_callback(self, topic, payload):
+        self.loop.call_soon_threadsafe(self.coordinator.handle_heartbeat, payload.decode())
     
     def _subscribe_callback(self, topic, payload):
         print("Received message from topic '{}': {}".format(topic, payload))
@@ -94,7 +185,7 @@ class NotificationDelegate(DefaultDelegate):
         try:
             data = self.__decode_json_data(data)
             data['timestamp'] = time.time()
-            self.mqtt_manager.publish(SENSOR_DATA_TOPIC,data)
+            self.mqtt_manager.publish_sensor_data(data)
         except Exception as e:
             print(f"Failed to publish data: {e}")
             
@@ -109,6 +200,22 @@ class AsyncBLEManager:
         self.mqtt_manager = mqtt_manager
         self.devices_to_connect = []
         self.connected_peripherals = {}
+        self.device_tasks = {}
+        self.sightings = {}
+        self.coordinator = None
+
+    def attach_coordinator(self, coordinator):
+        self.coordinator = coordinator
+
+    def owns(self, addr):
+        return self.coordinator is None or self.coordinator.owns(addr)
+
+    def heard_nodes(self):
+        # Nodes seen advertising recently, plus those this gateway is connected to
+        # (a connected node stops advertising)
+        now = time.monotonic()
+        recent = [addr for addr, seen in self.sightings.items() if now - seen <= SIGHTING_TIMEOUT]
+        return set(recent) | set(self.connected_peripherals)
 
     async def scan_for_devices(self):
         while True:
@@ -119,8 +226,10 @@ class AsyncBLEManager:
                 for dev in devices:
                     for (adtype, desc, value) in dev.getScanData():
                         if value.startswith(self.device_name_prefix):
-                            self.devices_to_connect.append(dev.addr)
-                            print(f"Found BLE device with address: {dev.addr} {value}")
+                            self.sightings[dev.addr] = time.monotonic()
+                            if dev.addr not in self.devices_to_connect:
+                                self.devices_to_connect.append(dev.addr)
+                                print(f"Found BLE device with address: {dev.addr} {value}")
                 break
             except BTLEException as e:
                 print(f"[ERROR SCANNING]: {e}")
@@ -137,9 +246,25 @@ class AsyncBLEManager:
         tasks = [self.loop.create_task(self.handle_device_connection(addr)) for addr in self.devices_to_connect]
         await asyncio.gather(*tasks)
 
+    async def scan_and_rebalance(self):
+        # Nodes held by another gateway do not advertise, so a rescan only finds
+        # new nodes and those released by a gateway that left or handed them over
+        while True:
+            await self.scan_for_devices()
+            for addr in self.devices_to_connect:
+                if self.owns(addr) and addr not in self.device_tasks:
+                    print(f"[CLAIMED] {addr}")
+                    self.device_tasks[addr] = self.loop.create_task(self.handle_device_connection(addr))
+            self.devices_to_connect = [addr for addr in self.devices_to_connect if addr not in self.device_tasks]
+            await asyncio.sleep(RESCAN_INTERVAL)
+
 
     async def handle_device_connection(self, addr):
         while True:
+            if not self.owns(addr):
+                print(f"[RELEASED] {addr} is owned by another gateway")
+                self.device_tasks.pop(addr, None)
+                return
             try:
                 self.connected_peripherals[addr] = Peripheral(addr)
                 self.connected_peripherals[addr].setMTU(MTU)
@@ -153,12 +278,17 @@ class AsyncBLEManager:
                         for char in characteristics:
                             if char.uuid == UUID(SENSOR_DATA_UUID):
                                 await self.loop.run_in_executor(None, self.connected_peripherals[addr].writeCharacteristic, char.getHandle() + 1, b"\x01\x00")
-                                while True:
+                                while self.owns(addr):
                                     try:
                                         await self.loop.run_in_executor(None, self.connected_peripherals[addr].waitForNotifications, 1.0)
                                     except Exception as e:
                                         print(f"Failed to wait for notifications: {e}")
                                         raise Exception
+                                # Ownership moved: disconnect so the node advertises to its new gateway
+                                self.cleanup_peripheral(addr)
+                                self.device_tasks.pop(addr, None)
+                                print(f"[RELEASED] {addr} is owned by another gateway")
+                                return
             
             except BTLEDisconnectError as e:
                 print(f"Connection to {addr} lost: {e}")
@@ -200,11 +330,15 @@ class AsyncBLEManager:
     
 
 class AsyncNodeManager:
-    def __init__(self, ble_manager, mqtt_manager):
+    def __init__(self, ble_manager, mqtt_manager, coordinator=None):
         self.ble_manager = ble_manager
         self.mqtt_manager = mqtt_manager
+        self.coordinator = coordinator
 
     async def run(self):
+        if self.coordinator:
+            await asyncio.gather(self.coordinator.run(), self.ble_manager.scan_and_rebalance())
+            return
         await self.ble_manager.scan_for_devices()
         await self.ble_manager.connect_and_listen()
 
@@ -213,7 +347,13 @@ async def main():
     mqtt_manager = AsyncMQTTManager(MQTT_BROKER_ENDPOINT, CLIENT_ID, loop)
     ble_manager = AsyncBLEManager(DEVICE_NAME_PREFIX, mqtt_manager, loop)
     mqtt_manager.attach_ble_manager(ble_manager)
-    node_manager = AsyncNodeManager(ble_manager, mqtt_manager)
+    coordinator = None
+    if MULTI_GATEWAY_MODE:
+        coordinator = GatewayCoordinator(GATEWAY_ID, mqtt_manager.publish_heartbeat, ble_manager.heard_nodes)
+        mqtt_manager.attach_coordinator(coordinator)
+        ble_manager.attach_coordinator(coordinator)
+    await mqtt_manager.connect()
+    node_manager = AsyncNodeManager(ble_manager, mqtt_manager, coordinator)
     await node_manager.run()
     
 